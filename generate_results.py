@@ -4,19 +4,34 @@ Generate comparison results: PolicyEngine vs OBR salary sacrifice cap.
 Outputs CSV files to public/data/ for the React dashboard.
 
 Requires: policyengine_uk (pip install policyengine-uk)
-Runtime: ~2-3 minutes (6 simulations x ~12s each)
+Runtime: ~1 minute on 4+ cores (6 simulations x ~12s each; scenarios run in parallel)
 """
 
 import os
-import csv
 import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 import numpy as np
 import pandas as pd
 import h5py
+from scipy import sparse
 from policyengine_uk import Microsimulation
 from policyengine_uk.utils.scenario import Scenario
-from microdf import MicroSeries
+
+try:
+    from numba import get_num_threads, njit, prange
+    HAS_NUMBA = True
+except ImportError:  # fall back to the numexpr/NumPy versions below
+    import numexpr as ne
+    HAS_NUMBA = False
+
+    def njit(*args, **kwargs):
+        if args and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+    prange = range
 
 OUT_DIR = os.path.join(os.path.dirname(__file__), "public", "data")
 os.makedirs(OUT_DIR, exist_ok=True)
@@ -57,33 +72,206 @@ OBR = {
 
 
 # ── Reform Function ────────────────────────────────────────────────
+@njit(parallel=True, fastmath=True)
+def _haircut_rate(ss, emp, cap, er_rate, pt_rate):
+    """Wage cut that spreads the passed-through employer NICs over all pay."""
+    excess_sum = 0.0
+    emp_sum = 0.0
+    for i in prange(len(ss)):
+        excess_sum += max(ss[i] - cap, 0.0)
+        emp_sum += emp[i]
+    if emp_sum > 0:
+        return excess_sum * er_rate * pt_rate / emp_sum
+    return 0.0
+
+
+@njit(parallel=True, fastmath=True)
+def _apply_cap(ss, emp, pens, cap, haircut_rate, redirect):
+    """Fused cap kernel returning (new_emp, new_pens, new_ss)."""
+    new_emp = np.empty_like(emp)
+    new_pens = np.empty_like(pens)
+    new_ss = np.empty_like(ss)
+    for i in prange(len(ss)):
+        excess = max(ss[i] - cap, 0.0)
+        new_emp[i] = emp[i] * (1 - haircut_rate) + excess
+        new_pens[i] = pens[i] + excess if redirect else pens[i]
+        new_ss[i] = min(ss[i], cap)
+    return new_emp, new_pens, new_ss
+
+
+@njit
+def _baseline_stats(ss, emp, weights, cap):
+    """Weighted baseline totals over persons in a single pass.
+
+    Returns (ss users, workers above cap, employed, wages, excess over cap).
+    """
+    total_ss_w = 0.0
+    above_cap_w = 0.0
+    workers_w = 0.0
+    wages = 0.0
+    excess_w = 0.0
+    for i in range(len(ss)):
+        w = weights[i]
+        wages += emp[i] * w
+        if emp[i] > 0:
+            workers_w += w
+        if ss[i] > 0:
+            total_ss_w += w
+        if ss[i] > cap:
+            above_cap_w += w
+            excess_w += (ss[i] - cap) * w
+    return total_ss_w, above_cap_w, workers_w, wages, excess_w
+
+
+@njit(parallel=True)
+def _decile_sums(decile_idx, weight, people, baseline, reformed, threshold):
+    """Per-decile household totals in one pass.
+
+    Returns a (6, 11) array of weight, baseline income, reformed income,
+    people, losers and winners, indexed by decile. A household wins or
+    loses when its income changes by more than ``threshold`` percent. Each
+    thread accumulates into its own row block, summed at the end.
+    """
+    n = len(decile_idx)
+    n_chunks = get_num_threads()
+    chunk = (n + n_chunks - 1) // n_chunks
+    acc = np.zeros((n_chunks, 6, 11))
+    for c in prange(n_chunks):
+        for i in range(c * chunk, min(n, (c + 1) * chunk)):
+            d = decile_idx[i]
+            w = weight[i]
+            wc = w * people[i]
+            acc[c, 0, d] += w
+            acc[c, 1, d] += baseline[i] * w
+            acc[c, 2, d] += reformed[i] * w
+            acc[c, 3, d] += wc
+            pct_change = (reformed[i] - baseline[i]) / max(baseline[i], 1.0) * 100
+            if pct_change < -threshold:
+                acc[c, 4, d] += wc
+            elif pct_change > threshold:
+                acc[c, 5, d] += wc
+    return acc.sum(axis=0)
+
+
+def _haircut_rate_numexpr(ss, emp, cap, er_rate, pt_rate):
+    """numexpr equivalent of _haircut_rate for environments without numba."""
+    emp_sum = emp.sum()
+    if emp_sum > 0:
+        excess_sum = ne.evaluate("sum(where(ss > cap, ss - cap, 0))")
+        return excess_sum * er_rate * pt_rate / emp_sum
+    return 0.0
+
+
+def _apply_cap_numexpr(ss, emp, pens, cap, haircut_rate, redirect):
+    """numexpr equivalent of _apply_cap for environments without numba."""
+    new_emp = ne.evaluate("emp * (1 - haircut_rate) + where(ss > cap, ss - cap, 0)")
+    if redirect:
+        new_pens = ne.evaluate("pens + where(ss > cap, ss - cap, 0)")
+    else:
+        new_pens = pens.copy()
+    new_ss = ne.evaluate("where(ss > cap, cap, ss)")
+    return new_emp, new_pens, new_ss
+
+
+def _baseline_stats_numpy(ss, emp, weights, cap):
+    """NumPy equivalent of _baseline_stats for environments without numba."""
+    excess = np.subtract(ss, cap)
+    np.maximum(excess, 0, out=excess)
+    return (
+        weights[ss > 0].sum(),
+        weights[ss > cap].sum(),
+        weights[emp > 0].sum(),
+        np.dot(emp, weights),
+        np.dot(excess, weights),
+    )
+
+
+def _decile_sums_numpy(decile_idx, weight, people, baseline, reformed,
+                       threshold):
+    """NumPy/numexpr equivalent of _decile_sums for environments without numba."""
+    pct_change = ne.evaluate(
+        "(reformed - baseline) / where(baseline > 1, baseline, 1) * 100"
+    )
+    wc = people * weight
+    columns = [
+        weight,
+        baseline * weight,
+        reformed * weight,
+        wc,
+        wc * (pct_change < -threshold),
+        wc * (pct_change > threshold),
+    ]
+    return np.stack([np.bincount(decile_idx, weights=c, minlength=11)
+                     for c in columns])
+
+
 def create_cap_reform(cap, year, employer_ni_rate, pass_through_rate,
                       redirect_to_pension=True):
+    if HAS_NUMBA:
+        haircut_rate, apply_cap = _haircut_rate, _apply_cap
+    else:
+        haircut_rate, apply_cap = _haircut_rate_numexpr, _apply_cap_numexpr
+
+    if pass_through_rate > 0:
+        def haircut(ss, emp):
+            return haircut_rate(ss, emp, cap, employer_ni_rate, pass_through_rate)
+    else:
+        # Employers absorb the cost: no wage cut, so skip its reductions
+        def haircut(ss, emp):
+            return 0.0
+
     def modify(sim):
         ss = sim.calculate("pension_contributions_via_salary_sacrifice", period=year).values
         emp = sim.calculate("employment_income", period=year).values
         pens = sim.calculate("employee_pension_contributions", period=year).values
-        excess = np.maximum(ss - cap, 0)
-        pension_redirect = excess if redirect_to_pension else np.zeros_like(excess)
-        if pass_through_rate > 0 and emp.sum() > 0:
-            total_ni_increase = (excess * employer_ni_rate).sum()
-            passed_cost = total_ni_increase * pass_through_rate
-            haircut_rate = passed_cost / emp.sum()
-            new_emp = emp * (1 - haircut_rate) + excess
-        else:
-            new_emp = emp + excess
+        new_emp, new_pens, new_ss = apply_cap(
+            ss, emp, pens, cap, haircut(ss, emp), redirect_to_pension,
+        )
         sim.set_input("employment_income", year, new_emp)
-        sim.set_input("employee_pension_contributions", year, pens + pension_redirect)
-        sim.set_input("pension_contributions_via_salary_sacrifice", year, np.minimum(ss, cap))
+        sim.set_input("employee_pension_contributions", year, new_pens)
+        sim.set_input("pension_contributions_via_salary_sacrifice", year, new_ss)
     return modify
 
 
+# Microdata loaded by the baseline, handed to each scenario worker once so
+# reform simulations skip re-reading and uprating the dataset.
+_dataset = None
+
+
+def _init_worker(dataset):
+    global _dataset
+    _dataset = dataset
+
+
+def _run_scenario(s, baseline_balance):
+    """Run one reform scenario; returns (name, revenue_bn, seconds)."""
+    t0 = time.time()
+    modifier = create_cap_reform(
+        cap=CAP, year=YEAR, employer_ni_rate=NEW_NI_RATE,
+        pass_through_rate=s["pass_through"], redirect_to_pension=s["redirect"],
+    )
+    reformed = Microsimulation(
+        dataset=_dataset, scenario=Scenario(simulation_modifier=modifier),
+    )
+    reformed_balance = reformed.calculate("gov_balance", period=YEAR).sum()
+    return s["name"], (reformed_balance - baseline_balance) / 1e9, time.time() - t0
+
+
+def cached_values(sim, year):
+    """Return a getter that calculates each variable on ``sim`` at most once."""
+    cache = {}
+
+    def get(variable, map_to=None):
+        key = (variable, map_to)
+        if key not in cache:
+            cache[key] = sim.calculate(variable, period=year, map_to=map_to).values
+        return cache[key]
+    return get
+
+
 def write_csv(filename, rows, headers):
     path = os.path.join(OUT_DIR, filename)
-    with open(path, "w", newline="") as f:
-        writer = csv.writer(f)
-        writer.writerow(headers)
-        writer.writerows(rows)
+    pd.DataFrame(rows, columns=headers).to_csv(path, index=False)
     print(f"  Wrote {path}")
 
 
@@ -94,25 +282,19 @@ def main():
     print("Running baseline simulation...")
     baseline = Microsimulation()
     baseline_balance = baseline.calculate("gov_balance", period=YEAR).sum()
+    bget = cached_values(baseline, YEAR)
 
-    ss = baseline.calculate("pension_contributions_via_salary_sacrifice", period=YEAR).values
-    emp = baseline.calculate("employment_income", period=YEAR).values
-    weights = baseline.calculate("person_weight", period=YEAR).values
-
-    has_ss = ss > 0
-    above_cap = ss > CAP
-    has_employment = emp > 0
+    ss = bget("pension_contributions_via_salary_sacrifice")
+    emp = bget("employment_income")
+    weights = bget("person_weight")
 
-    pe_total_ss = weights[has_ss].sum()
-    pe_above_cap = weights[above_cap].sum()
+    baseline_stats = _baseline_stats if HAS_NUMBA else _baseline_stats_numpy
+    (pe_total_ss, pe_above_cap, pe_total_workers,
+     pe_total_wages, pe_total_excess) = baseline_stats(ss, emp, weights, CAP)
     pe_below_cap = pe_total_ss - pe_above_cap
-    pe_total_workers = weights[has_employment].sum()
-    pe_total_wages = (emp * weights).sum()
-    pe_total_excess = (np.maximum(ss - CAP, 0) * weights).sum()
-    pe_avg_excess = (
-        (np.maximum(ss - CAP, 0)[above_cap] * weights[above_cap]).sum()
-        / weights[above_cap].sum()
-    )
+    # Only workers above the cap have any excess, so the average over them
+    # is the total excess divided by their weight.
+    pe_avg_excess = pe_total_excess / pe_above_cap
 
     obr_avg_excess = OBR["ss_tax_base_bn"] * 1e9 / OBR["affected_above_2k"]
 
@@ -154,11 +336,12 @@ def main():
     )
 
     # ── 5. NICs Rates CSV ──────────────────────────────────────────
-    taxable_income = baseline.calculate("adjusted_net_income", period=YEAR).values
+    taxable_income = bget("adjusted_net_income")
+    above_cap = ss > CAP
     basic_above = above_cap & (taxable_income <= 50270)
     higher_above = above_cap & (taxable_income > 50270)
-    pct_basic = weights[basic_above].sum() / weights[above_cap].sum()
-    pct_higher = weights[higher_above].sum() / weights[above_cap].sum()
+    pct_basic = weights[basic_above].sum() / pe_above_cap
+    pct_higher = weights[higher_above].sum() / pe_above_cap
     pe_implied_ee = pct_basic * 0.08 + pct_higher * 0.02
     write_csv("nics_rates.csv",
         [
@@ -179,25 +362,28 @@ def main():
         {"name": "OBR 76% pass-through + Maintain pension", "pass_through": 0.76, "redirect": True},
     ]
 
+    # Scenarios are independent, so run them in worker processes. Spawn
+    # rather than fork to avoid inheriting the baseline's thread pools.
+    with ProcessPoolExecutor(
+        max_workers=min(len(scenario_defs), os.cpu_count() or 1),
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(baseline.dataset,),
+    ) as ex:
+        outcomes = list(ex.map(_run_scenario, scenario_defs,
+                               [float(baseline_balance)] * len(scenario_defs)))
+
     results = {}
     scenario_rows = []
-    for s in scenario_defs:
-        t0 = time.time()
-        modifier = create_cap_reform(
-            cap=CAP, year=YEAR, employer_ni_rate=NEW_NI_RATE,
-            pass_through_rate=s["pass_through"], redirect_to_pension=s["redirect"],
-        )
-        reformed = Microsimulation(scenario=Scenario(simulation_modifier=modifier))
-        reformed_balance = reformed.calculate("gov_balance", period=YEAR).sum()
-        revenue_bn = (reformed_balance - baseline_balance) / 1e9
-        results[s["name"]] = revenue_bn
+    for s, (name, revenue_bn, elapsed) in zip(scenario_defs, outcomes):
+        results[name] = revenue_bn
         scenario_rows.append([
-            s["name"],
+            name,
             f"{int(s['pass_through']*100)}",
             str(s["redirect"]).lower(),
             f"{revenue_bn:.2f}",
         ])
-        print(f"  {s['name']}: £{revenue_bn:.2f}bn ({time.time()-t0:.1f}s)")
+        print(f"  {name}: £{revenue_bn:.2f}bn ({elapsed:.1f}s)")
 
     write_csv("scenarios.csv", scenario_rows,
               ["name", "pass_through_pct", "redirect_to_pension", "revenue_bn"])
@@ -205,19 +391,26 @@ def main():
     # ── 7. Revenue Decomposition ───────────────────────────────────
     modifier = create_cap_reform(cap=CAP, year=YEAR, employer_ni_rate=NEW_NI_RATE,
                                  pass_through_rate=0.0, redirect_to_pension=True)
-    reformed_decomp = Microsimulation(scenario=Scenario(simulation_modifier=modifier))
-    rw = reformed_decomp.calculate("person_weight", period=YEAR).values
-
-    b_it = (baseline.calculate("income_tax", period=YEAR).values * weights).sum()
-    r_it = (reformed_decomp.calculate("income_tax", period=YEAR).values * rw).sum()
+    reformed_decomp = Microsimulation(
+        dataset=baseline.dataset, scenario=Scenario(simulation_modifier=modifier),
+    )
+    rget = cached_values(reformed_decomp, YEAR)
+    # Reduce against float64 weights so np.dot accumulates in double
+    # precision; the revenue changes are small differences of large totals.
+    # The reform only changes incomes, so both simulations share the
+    # baseline's person weights.
+    w64 = weights.astype(np.float64)
+
+    b_it = np.dot(bget("income_tax"), w64)
+    r_it = np.dot(rget("income_tax"), w64)
     d_it = (r_it - b_it) / 1e9
 
-    b_ee = (baseline.calculate("national_insurance", period=YEAR).values * weights).sum()
-    r_ee = (reformed_decomp.calculate("national_insurance", period=YEAR).values * rw).sum()
+    b_ee = np.dot(bget("national_insurance"), w64)
+    r_ee = np.dot(rget("national_insurance"), w64)
     d_ee = (r_ee - b_ee) / 1e9
 
-    b_er = (baseline.calculate("ni_employer", period=YEAR).values * weights).sum()
-    r_er = (reformed_decomp.calculate("ni_employer", period=YEAR).values * rw).sum()
+    b_er = np.dot(bget("ni_employer"), w64)
+    r_er = np.dot(rget("ni_employer"), w64)
     d_er = (r_er - b_er) / 1e9
 
     write_csv("revenue_decomposition.csv",
@@ -232,12 +425,12 @@ def main():
     )
 
     # ── 8. IT Leakage ─────────────────────────────────────────────
-    b_pptax = (baseline.calculate("personal_pension_contributions_tax", period=YEAR).values * weights).sum()
-    r_pptax = (reformed_decomp.calculate("personal_pension_contributions_tax", period=YEAR).values * rw).sum()
+    b_pptax = np.dot(bget("personal_pension_contributions_tax"), w64)
+    r_pptax = np.dot(rget("personal_pension_contributions_tax"), w64)
     d_pptax = (r_pptax - b_pptax) / 1e9
 
-    b_relief = (baseline.calculate("pension_contributions_relief", period=YEAR).values * weights).sum()
-    r_relief = (reformed_decomp.calculate("pension_contributions_relief", period=YEAR).values * rw).sum()
+    b_relief = np.dot(bget("pension_contributions_relief"), w64)
+    r_relief = np.dot(rget("pension_contributions_relief"), w64)
     d_relief = (r_relief - b_relief) / 1e9
 
     write_csv("it_leakage.csv",
@@ -268,20 +461,30 @@ def main():
     )
 
     # ── 10. Distributional Impact ──────────────────────────────────
-    baseline_hh_income = baseline.calculate("household_net_income", period=YEAR).values
-    reformed_hh_income = reformed_decomp.calculate("household_net_income", period=YEAR).values
-    hh_decile = baseline.calculate("household_income_decile", period=YEAR).values
-    hh_weight = baseline.calculate("household_weight", period=YEAR).values
+    baseline_hh_income = bget("household_net_income")
+    reformed_hh_income = rget("household_net_income")
+    hh_decile = bget("household_income_decile")
+    hh_weight = bget("household_weight")
+    hh_count_people = bget("household_count_people")
+    # Group index for the per-decile totals; bin 0 collects households
+    # outside deciles 1-10 and is dropped.
+    decile_idx = np.where(hh_decile >= 1, hh_decile, 0)
+
+    threshold = 0.01
+
+    # Totals for this and the winners/losers table in one household pass
+    decile_sums = _decile_sums if HAS_NUMBA else _decile_sums_numpy
+    wsum, bsum, rsum, people, loser_people, winner_people = decile_sums(
+        decile_idx, hh_weight, hh_count_people, baseline_hh_income,
+        reformed_hh_income, threshold,
+    )[:, 1:11]
 
     dist_rows = []
-    for d in range(1, 11):
-        mask = hh_decile == d
-        w = hh_weight[mask]
-        total_w = w.sum()
+    for d, total_w, b, r in zip(range(1, 11), wsum, bsum, rsum):
         if total_w == 0:
             continue
-        avg_baseline_val = (baseline_hh_income[mask] * w).sum() / total_w
-        avg_reformed_val = (reformed_hh_income[mask] * w).sum() / total_w
+        avg_baseline_val = b / total_w
+        avg_reformed_val = r / total_w
         avg_change = avg_reformed_val - avg_baseline_val
         pct_change = 100 * avg_change / avg_baseline_val if avg_baseline_val != 0 else 0
         dist_rows.append([d, f"{avg_baseline_val:.0f}", f"{avg_reformed_val:.0f}",
@@ -291,23 +494,12 @@ def main():
               ["decile", "avg_baseline", "avg_reformed", "avg_change_gbp", "pct_change"])
 
     # ── 11. Winners & Losers ───────────────────────────────────────
-    income_change = reformed_hh_income - baseline_hh_income
-    capped_baseline = np.maximum(baseline_hh_income, 1)
-    pct_change_hh = (income_change / capped_baseline) * 100
-    hh_count_people = baseline.calculate("household_count_people", period=YEAR).values
-    valid_mask = hh_decile >= 1
-    threshold = 0.01
-
     wl_rows = []
-    for d in range(1, 11):
-        decile_mask = valid_mask & (hh_decile == d)
-        total_people = (hh_count_people[decile_mask] * hh_weight[decile_mask]).sum()
+    for d, total_people, losers, winners in zip(
+        range(1, 11), people, loser_people, winner_people
+    ):
         if total_people == 0:
             continue
-        losers = (hh_count_people[decile_mask & (pct_change_hh < -threshold)] *
-                  hh_weight[decile_mask & (pct_change_hh < -threshold)]).sum()
-        winners = (hh_count_people[decile_mask & (pct_change_hh > threshold)] *
-                   hh_weight[decile_mask & (pct_change_hh > threshold)]).sum()
         no_change = total_people - losers - winners
         wl_rows.append([
             d,
@@ -326,36 +518,35 @@ def main():
 
     if weights_path.exists() and constituencies_path.exists():
         with h5py.File(weights_path, "r") as f:
-            constituency_weights = f["2025"][...]
+            # float32 halves the memory and bandwidth of the seat matrix
+            constituency_weights = f["2025"].astype(np.float32)[...]
 
         constituency_df = pd.read_csv(constituencies_path)
-
-        baseline_income = baseline.calculate(
-            "household_net_income", period=YEAR, map_to="household"
-        ).values
-        reform_income = reformed_decomp.calculate(
-            "household_net_income", period=YEAR, map_to="household"
-        ).values
-
-        constituency_results = []
-        for i in range(len(constituency_df)):
-            name = constituency_df.iloc[i]["name"]
-            code = constituency_df.iloc[i]["code"]
-            weight = constituency_weights[i]
-
-            baseline_ms = MicroSeries(baseline_income, weights=weight)
-            reform_ms = MicroSeries(reform_income, weights=weight)
-
-            avg_change = (
-                reform_ms.sum() - baseline_ms.sum()
-            ) / baseline_ms.count()
-
-            constituency_results.append([
-                f"{YEAR}-{str(YEAR+1)[-2:]}",
-                code,
-                name,
-                f"{avg_change:.2f}",
-            ])
+        names = constituency_df["name"].to_numpy()
+        codes = constituency_df["code"].to_numpy()
+
+        baseline_income = bget("household_net_income", map_to="household")
+        reform_income = rget("household_net_income", map_to="household")
+
+        # Take the difference before dropping to float32, so the seat totals
+        # don't lose precision to cancellation between two large sums.
+        income_change = (reform_income - baseline_income).astype(np.float32)
+
+        seat_weights = constituency_weights.sum(axis=1, dtype=np.float64)
+        # If most households carry no weight in most seats, a CSR product
+        # only touches the non-zero entries.
+        if np.count_nonzero(constituency_weights) < 0.1 * constituency_weights.size:
+            constituency_weights = sparse.csr_array(constituency_weights)
+
+        # Weighted sums for every seat at once: [n_seats, n_hh] @ [n_hh]
+        change_sums = constituency_weights @ income_change
+        avg_changes = change_sums / seat_weights
+
+        year_str = f"{YEAR}-{str(YEAR+1)[-2:]}"
+        constituency_results = list(zip(
+            [year_str] * len(codes), codes, names,
+            np.char.mod("%.2f", avg_changes),
+        ))
 
         write_csv("constituency.csv", constituency_results,
                   ["year", "constituency_code", "constituency_name", "avg_change"])